@@ -1,22 +1,24 @@
 '''py2math: Convert Python objects to Latex math for use in jupyter notebooks.'''
 
-import inspect
-from lark.lexer import Token
-from lark.lark import Lark
-from lark.visitors import Interpreter
-from lark.indenter import PythonIndenter
+import ast
 
 
-# import python grammar from lark
-# https://github.com/lark-parser/lark/blob/master/lark/grammars/python.lark
-parser = Lark.open_from_package(
-    'lark',
-    'python.lark',
-    ['grammars'],
-    parser='lalr',
-    postlex=PythonIndenter(),
-    start='file_input'
-)
+# brackets for the supported container types
+_BRACKETS = {
+    list: '[]',
+    tuple: '()',
+    set: '{}',
+}
+
+
+# cache of finished conversions keyed by code object, so re-rendering the same
+# function (e.g. when re-executing a notebook cell) skips source retrieval, parsing and conversion
+_result_cache = {}
+
+# second-level cache keyed by the source text itself: re-executing a notebook cell
+# creates a fresh code object for unchanged source, and classes have no __code__ at
+# all, but both still render to the same latex (the output only depends on the source)
+_source_cache = {}
 
 
 def py2math(obj, debug=False) -> 'Math':
@@ -30,228 +32,331 @@ def py2math(obj, debug=False) -> 'Math':
         Math: The resulting latex math, as a subclass of `str`, which is displayed as math in jupyter notebooks.
     """
     if isinstance(obj, (list, tuple, set)):
-        # parse nested code
-        b1, b2 = {
-            list: '[]',
-            tuple: '()',
-            set: '{}'
-        }[type(obj)]
+        # walk nested containers iteratively with an explicit stack, emitting into one
+        # shared buffer, instead of recursing with a python frame per nesting level
         # TODO: maybe add `,` in one-element tuples
-        return Math(f'\\left{b1}' + ', '.join(py2math(x, debug=debug) for x in obj) + f'\\right{b2}')
-    elif obj == ...:
+        b1, b2 = _BRACKETS[type(obj)]
+        out = [f'\\left{b1}']
+        # each stack entry is the iterator of an open container, its closing bracket,
+        # and whether an element was already emitted (to place separators)
+        stack = [[iter(obj), f'\\right{b2}', False]]
+        while stack:
+            top = stack[-1]
+            try:
+                x = next(top[0])
+            except StopIteration:
+                out.append(top[1])
+                stack.pop()
+                continue
+            if top[2]:
+                out.append(', ')
+            top[2] = True
+            if isinstance(x, (list, tuple, set)):
+                b1, b2 = _BRACKETS[type(x)]
+                out.append(f'\\left{b1}')
+                stack.append([iter(x), f'\\right{b2}', False])
+            else:
+                out.append(_convert_scalar(x, debug))
+        return Math(''.join(out))
+    else:
+        return _convert_scalar(obj, debug)
+
+
+def _convert_scalar(obj, debug) -> 'Math':
+    '''convert a single (non-container) object to latex math'''
+    # deferred: inspect pulls in dis, tokenize etc., which is most of this module's import
+    # cost; after the first call this is just a sys.modules lookup
+    import inspect
+    if obj == ...:
         # convert Ellipses to dots
         return Math('...')
-    else:
-        try:
-            # try to get the source code for the given object
-            code = inspect.getsource(obj)
-        except TypeError as err:
-            # if `obj` isn't a function, class or similar object (which has code) print it directly
-            return Math(str(obj))
-        if debug: print('"' + code + '"')
-        parse_tree = parser.parse(code)
-        if debug: print(parse_tree.pretty())
-        result = Math(Converter().visit(parser.parse(code)))
+    # code objects hash by content (incl. name and constants), so they make a safe cache key
+    key = getattr(obj, '__code__', None)
+    if key is not None and not debug and key in _result_cache:
+        return _result_cache[key]
+    try:
+        # try to get the source code for the given object
+        code = inspect.getsource(obj)
+    except TypeError as err:
+        # if `obj` isn't a function, class or similar object (which has code) print it directly
+        return Math(str(obj))
+    if debug: print('"' + code + '"')
+    result = None if debug else _source_cache.get(code)
+    if result is None:
+        # parse with CPython's own (C-implemented) parser
+        tree = ast.parse(code)
+        if debug: print(ast.dump(tree, indent=2))
+        # reuse the module-level Converter; it carries no state between calls besides the
+        # output buffer, which is cleared here
+        _converter._out.clear()
+        _converter.visit(tree)
+        result = Math(''.join(_converter._out))
         if debug: print(result._repr_latex_())
-        return result
+        _source_cache[code] = result
+    if key is not None:
+        _result_cache[key] = result
+    return result
 
 
 class Math(str):
     '''Superclass of string which is printed as math in jupyter notebooks'''
-    def _repr_latex_(self):
-        return f'$$ {self} $$'
-
-
-def bracketize(x : 'Token | str') -> 'Token | str':
-    '''put brackets around non-trivial expressions (which are not of type str)'''
-    # TODO: check if `isinstance(x, Token)` is reliable, or if elements of obj.children should be used here
-    # TODO: maybe too many brackets
-    return x if isinstance(x, Token) else f'\\left({x}\\right)'
-
-
-class Converter(Interpreter):
-
-    def file_input(self, tree):
-        idk, = self.visit_children(tree)
-        return idk
-
-    def eval_input(self, tree):
-        # TODO: maybe remove, if e.g. file_input is made the default
-        idk, = self.visit_children(tree)
-        return idk
-
-    def expr_stmt(self, tree):
-        idk, = self.visit_children(tree)
-        return idk
+    def __new__(cls, value=''):
+        self = super().__new__(cls, value)
+        # precompute the display string once; _repr_latex_ runs on every cell render
+        self._latex = f'$$ {self} $$'
+        return self
 
-    def funcdef(self, tree):
-        name, parameters, return_type, suite = self.visit_children(tree)
-        # TODO: handle return type
-        return f'{name}({", ".join(x for x in parameters if x)}) = {suite}'
-
-    def paramvalue(self, tree):
-        typedparam, default_val = self.visit_children(tree)
-        # TODO: handle the default value of the parameter
-        return typedparam
-
-    def typedparam(self, tree):
-        name, param_type = self.visit_children(tree)
-        # TODO: handle the type of the parameter
-        return name
-
-    def assign_stmt(self, tree):
-        idk, = self.visit_children(tree)
-        return idk
-
-    def assign(self, tree):
-        name, value = self.visit_children(tree)
+    def _repr_latex_(self):
+        return self._latex
+
+
+# comparison operators to latex, keyed by the ast operator class
+_CMP_OPS = {
+    ast.Lt: ' < ',
+    ast.Gt: ' > ',
+    ast.Eq: ' = ',
+    ast.GtE: ' \\geq ',
+    ast.LtE: ' \\leq ',
+    ast.NotEq: ' \\neq ',
+    ast.In: ' \\in ',
+    ast.NotIn: ' \\notin ',
+    ast.Is: ' \\equiv ',
+    ast.IsNot: ' \\not\\equiv ',
+}
+
+
+# symbols of the binary operators which aren't translated yet, for error messages
+_TODO_BINOPS = {
+    ast.MatMult: '@',
+    ast.Mod: '%',
+    ast.FloorDiv: '//',
+    ast.BitOr: '|',
+    ast.BitXor: '^',
+    ast.BitAnd: '&',
+}
+
+
+class Converter(ast.NodeVisitor):
+    '''walks the ast and emits latex fragments into a shared buffer
+
+    Every handler appends its fragments to `self._out` instead of returning a
+    string, so each fragment is written exactly once instead of being re-copied
+    into every ancestor's intermediate result. The caller joins the buffer once.
+    '''
+
+    def __init__(self):
+        self._out = []
+
+    def generic_visit(self, node):
+        raise NotImplementedError(f'unsupported syntax: {type(node).__name__}')
+
+    def _bracketize(self, node):
+        # put brackets around non-trivial expressions (everything but bare variables and constants)
+        # TODO: maybe too many brackets
+        if type(node) is ast.Name or type(node) is ast.Constant:
+            self.visit(node)
+        else:
+            self._out.append('\\left(')
+            self.visit(node)
+            self._out.append('\\right)')
+
+    def visit_Module(self, node):
+        idk, = node.body
+        self.visit(idk)
+
+    def visit_Expr(self, node):
+        self.visit(node.value)
+
+    def visit_FunctionDef(self, node):
+        parameters = [arg.arg for arg in node.args.args]
+        # TODO: handle return type, parameter types and default values
+        # append constant fragments directly instead of re-formatting an f-string template
+        # filter(None, ...) drops empty names in C, without a python-level generator
+        self._out += (node.name, '(', ", ".join(filter(None, parameters)), ') = ')
+        self._suite(node.body)
+
+    def visit_Assign(self, node):
+        target, = node.targets
         # TODO: convert lambda to normal function or add variable definition to "with" section
-        return f'{name} = {value}'
+        self.visit(target)
+        self._out.append(' = ')
+        self.visit(node.value)
 
-    def suite(self, tree):
-        lines = self.visit_children(tree)
-        assert tree.children[-1].data == 'return_stmt', f'the last statement has to be a return, not `{tree.children[-1].data}`'
-        assert all(x.data == 'assign_stmt' for x in tree.children[:-1]), f'only assignments are supported before the return, but got {[f"{x.data}" for x in tree.children[:-1]]}'
+    def _suite(self, body):
+        assert isinstance(body[-1], ast.Return), f'the last statement has to be a return, not `{type(body[-1]).__name__}`'
+        assert all(isinstance(x, ast.Assign) for x in body[:-1]), f'only assignments are supported before the return, but got {[type(x).__name__ for x in body[:-1]]}'
         # TODO: extend translation capabilities and remove above constraint
-        if len(lines) == 1:
-            return lines[0]
-        else:
-            return (
-                lines[-1] +
-                '\\\\\n\\text{where}\\\\\n' +
-                '\\\\\n'.join(lines[:-1])
-            )
-
-    def return_stmt(self, tree):
-        value, = self.visit_children(tree)
-        return value
-
-    def test(self, tree):
-        option_a, condition, option_b = self.visit_children(tree)
-        return (
-            '\n'
-            '\\begin{cases}\n'
-            f'  {option_a} & \\text{{if }} {condition} \\\\\n'
-            f'  {option_b} & \\text{{otherwise}}\n'
-            '\\end{cases}\n'
-        )
-
-    def funccall(self, tree):
-        var, args = self.visit_children(tree)
-        return f'{var}({args})'
-
-    def arguments(self, tree):
-        args = self.visit_children(tree)
-        return ',\\ '.join(args)
-
-    def argvalue(self, tree):
-        argname, value = self.visit_children(tree)
-        # TODO: handle argmane
-        return value
-
-    def lambdef(self, tree):
-        params, expr = self.visit_children(tree)
-        ps = ",\\ ".join(filter(lambda x:x, params))
-        return f'({ps}) \\rightarrow {expr}'
-
-    def testlist_tuple(self, tree):
-        values = self.visit_children(tree)
-        if len(values) == 1:
+        self.visit(body[-1])
+        if len(body) > 1:
+            self._out.append('\\\\\n\\text{where}')
+            for line in body[:-1]:
+                self._out.append('\\\\\n')
+                self.visit(line)
+
+    def visit_Return(self, node):
+        self.visit(node.value)
+
+    def visit_IfExp(self, node):
+        out = self._out
+        out.append('\n\\begin{cases}\n  ')
+        self.visit(node.body)
+        out.append(' & \\text{if } ')
+        self.visit(node.test)
+        out.append(' \\\\\n  ')
+        self.visit(node.orelse)
+        out.append(' & \\text{otherwise}\n\\end{cases}\n')
+
+    def visit_Call(self, node):
+        out = self._out
+        self.visit(node.func)
+        out.append('(')
+        # TODO: handle keyword argument names
+        for i, arg in enumerate(node.args + [x.value for x in node.keywords]):
+            if i > 0:
+                out.append(',\\ ')
+            self.visit(arg)
+        out.append(')')
+
+    def visit_Lambda(self, node):
+        ps = ",\\ ".join(filter(None, [arg.arg for arg in node.args.args]))
+        self._out += ('(', ps, ') \\rightarrow ')
+        self.visit(node.body)
+
+    def _sequence(self, elements, left, right, separator=',\\ '):
+        out = self._out
+        out.append(left)
+        for i, x in enumerate(elements):
+            if i > 0:
+                out.append(separator)
+            self.visit(x)
+        out.append(right)
+
+    def visit_Tuple(self, node):
+        if len(node.elts) == 1:
             # TODO: is this actually desired?
-            return f'\\left({values[0]},\\right)'
+            self._sequence(node.elts, '\\left(', ',\\right)')
         else:
-            return '\\left(' + ',\\ '.join(values) + '\\right)'
+            self._sequence(node.elts, '\\left(', '\\right)')
 
-    def tuple(self, tree):
-        values = self.visit_children(tree)
-        if len(values) == 1:
-            return f'\\left({values[0]},\\right)'
-        else:
-            return '\\left(' + ',\\ '.join(values) + '\\right)'
+    def visit_List(self, node):
+        self._sequence(node.elts, '\\left[', '\\right]')
 
-    def set(self, tree):
-        elements = self.visit_children(tree)
+    def visit_Set(self, node):
         # TODO: test star expressions
-        return '\\left\\{' + ',\\ '.join(elements) + '\\right\\}'
-
-    def term(self, tree):
-        dividend = []
+        self._sequence(node.elts, '\\left\\{', '\\right\\}')
+
+    def _flatten(self, node, op_types):
+        '''flatten the left spine of nested BinOps (`a+b-c` parses as `BinOp(BinOp(a, b), c)`)
+        back into the flat `[operand, op, operand, ...]` chain the source spelled out'''
+        operands = []
+        ops = []
+        while isinstance(node, ast.BinOp) and type(node.op) in op_types:
+            operands.append(node.right)
+            ops.append(type(node.op))
+            node = node.left
+        operands.append(node)
+        operands.reverse()
+        ops.reverse()
+        return operands, ops
+
+    def _factors(self, factors):
+        '''emit the factors of a product, separated by `\\cdot`'''
+        if len(factors) == 1:
+            self.visit(factors[0])
+        else:
+            for i, x in enumerate(factors):
+                if i > 0:
+                    self._out.append(' \\cdot ')
+                self._bracketize(x)
+
+    def _term(self, node):
+        left = node.left
+        if not (isinstance(left, ast.BinOp) and type(left.op) in (ast.Mult, ast.Div)):
+            # fast path: plain binary `a * b` / `a / b`, by far the most common shape;
+            # no chain flattening or dividend/divisor bookkeeping needed
+            if type(node.op) is ast.Mult:
+                self._bracketize(left)
+                self._out.append(' \\cdot ')
+                self._bracketize(node.right)
+            else:
+                out = self._out
+                out.append('\\frac{')
+                self.visit(left)
+                out.append('}{')
+                self.visit(node.right)
+                out.append('}')
+            return
+        operands, ops = self._flatten(node, (ast.Mult, ast.Div))
+        if ast.Div not in ops:
+            # fast path: pure product, skip the dividend/divisor split entirely
+            self._factors(operands)
+            return
+        dividend = [operands[0]]
         divisor = []
-        dividing = False
-        for i, (x, x_obj) in enumerate(zip(self.visit_children(tree), tree.children)):
-            if i % 2 == 0:  # operand
-                if dividing:
-                    divisor += [x]
-                else:
-                    dividend += [x]
-            else:  # operator: *, /, @, %, //
-                if x in '*/':
-                    dividing = x == '/'
-                else:
-                    # TODO: implement other operators
-                    raise NotImplementedError(f'{x}')
-        if len(dividend) > 1:
-            dividend = [(bracketize(x)) for x in dividend]
-        dividend_str = ' \\cdot '.join(dividend)
+        # each factor belongs to the divisor iff the operator right before it is a `/`
+        for op, operand in zip(ops, operands[1:]):
+            (divisor if op is ast.Div else dividend).append(operand)
         if divisor:
-            if len(divisor) > 1:
-                divisor = [(bracketize(x)) for x in divisor]
             # TODO: use `\\cdot` or `\\times`?
             #   `\\cdot` might clash with matrix multiplication, but `\\times` might be visually disturbing
-            divisor_str = ' \\cdot '.join(divisor)
-            return f'\\frac{{{dividend_str}}}{{{divisor_str}}}'
+            out = self._out
+            out.append('\\frac{')
+            self._factors(dividend)
+            out.append('}{')
+            self._factors(divisor)
+            out.append('}')
+        else:
+            self._factors(dividend)
+
+    def _arith_expr(self, node):
+        # recurse down the left spine and emit on the way back up: a single pass over
+        # the chain without building the flattened operand/operator lists first
+        left = node.left
+        if isinstance(left, ast.BinOp) and type(left.op) in (ast.Add, ast.Sub):
+            self._arith_expr(left)
+        else:
+            self._bracketize(left)
+        self._out.append('+' if type(node.op) is ast.Add else '-')
+        self._bracketize(node.right)
+
+    def visit_BinOp(self, node):
+        op = type(node.op)
+        if op is ast.Add or op is ast.Sub:
+            self._arith_expr(node)
+        elif op is ast.Mult or op is ast.Div:
+            self._term(node)
+        elif op is ast.Pow:
+            out = self._out
+            out.append('{')
+            self._bracketize(node.left)
+            out.append('}^{')
+            self.visit(node.right)
+            out.append('}')
+        elif op is ast.LShift or op is ast.RShift:
+            # TODO
+            self._out.append('[shift_expr]')
         else:
-            return dividend_str
-
-    def arith_expr(self, tree):
-        result = ''
-        for i, (x, x_obj) in enumerate(zip(self.visit_children(tree), tree.children)):
-            if i % 2 == 0:  # operand
-                result += bracketize(x)
-            else:  # operator: +, -
-                result += x
-        return result
-
-    def power(self, tree):
-        base, exponent = self.visit_children(tree)
-        return f'{{{bracketize(base)}}}^{{{exponent}}}'
-
-    def shift_expr(self, tree):
-        # TODO
-        return '[shift_expr]'
-
-    def comparison(self, tree):
-        result = ''
-        for i, (x, x_obj) in enumerate(zip(self.visit_children(tree), tree.children)):
-            if i % 2 == 0:  # operand
-                result += bracketize(x)
-            else:  # operator: <, >, ==, >=, <=, <>, !=, in, not in, is, is not
-                result += {
-                    '<': ' < ',
-                    '>': ' > ',
-                    '==': ' = ',
-                    '>=': ' \\geq ',
-                    '<=': ' \\leq ',
-                    # '<>': '',  # not really valid, see PEP 401
-                    '!=': ' \\neq ',
-                    'in': ' \\in ',
-                    'not in': ' \\notin ',
-                    'is': ' \\equiv ',
-                    'is not': ' \\not\\equiv ',
-                }[' '.join(x)]
-        return result
-
-    def ellipsis(self, tree):
-        return '...'
-
-    def var(self, tree):
-        value, = tree.children
-        return value
-
-    def number(self, tree):
-        value, = tree.children
-        return value
-
-    def string(self, tree):
-        value, = tree.children
-        return f'\\text{{{value}}}'
+            # TODO: implement other operators
+            raise NotImplementedError(f'{_TODO_BINOPS.get(op, op.__name__)}')
+
+    def visit_Compare(self, node):
+        self._bracketize(node.left)
+        for op, comparator in zip(node.ops, node.comparators):
+            self._out.append(_CMP_OPS[type(op)])
+            self._bracketize(comparator)
+
+    def visit_Name(self, node):
+        self._out.append(node.id)
+
+    def visit_Constant(self, node):
+        if node.value is ...:
+            self._out.append('...')
+        elif isinstance(node.value, str):
+            # repr keeps the quotes, like the source token did
+            self._out += ('\\text{', repr(node.value), '}')
+        else:
+            self._out.append(str(node.value))
+
+
+# single reusable instance, so py2math does not allocate a new converter per call
+_converter = Converter()